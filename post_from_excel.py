@@ -1,6 +1,20 @@
-import os, json, time, re
-import pandas as pd
-from atproto import Client
+import os, json, re, time, asyncio, hashlib, datetime, logging
+from functools import lru_cache
+from itertools import chain, islice
+from typing import Iterator
+import aiometer
+from atproto import AsyncClient
+
+try:
+    from python_calamine import CalamineWorkbook  # Rust-backed, much faster than openpyxl
+except ImportError:
+    CalamineWorkbook = None
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    _dumps = lambda o: json.dumps(o, default=str).encode("utf-8")
 
 # ====== ENV VARS ======
 BSKY_HANDLE  = os.environ["BSKY_HANDLE"]
@@ -18,131 +32,355 @@ SHEET_NAME    = os.getenv("SHEET_NAME", None)  # None = first sheet
 # Debug/controls
 RESET_STATE          = os.getenv("RESET_STATE", "false").lower() == "true"
 FORCE_POST_FIRST_N   = int(os.getenv("FORCE_POST_FIRST_N", "0"))  # e.g., 1 or 3 to force a few posts
+SAVE_EVERY           = max(1, int(os.getenv("SAVE_EVERY", "10")))  # persist state every N posts
+
+# Posting pace
+POST_INTERVAL        = float(os.getenv("POST_INTERVAL", "2"))  # min seconds between post starts
+POST_CONCURRENCY     = max(1, int(os.getenv("POST_CONCURRENCY", "8")))  # max posts in flight
+MAX_RETRIES          = int(os.getenv("MAX_RETRIES", "5"))      # retries per post on HTTP 429
 
 STATE_FILE = "last_row.json"
 
+# LOG_LEVEL applies to this script only, so DEBUG doesn't also turn on httpx/asyncio chatter
+logging.basicConfig(format="[%(levelname)s] %(message)s")
+log = logging.getLogger("post")
+_log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+if _log_level in logging.getLevelNamesMapping():
+    log.setLevel(_log_level)
+else:
+    # A typo in the workflow env shouldn't stop scheduled runs
+    log.setLevel(logging.INFO)
+    log.warning("Unknown LOG_LEVEL %r, using INFO", _log_level)
+
+# Header patterns for auto-detecting the review column, fused into one
+# alternation so each header is scanned once
+_NEEDLES = (
+    r"\bethos\b.*\b(did|does)\b.*\bwell\b",
+    r"\bwhat\b.*\bethos\b.*\bwell\b",
+    r"\bwhat went well\b.*\bethos\b",
+    r"\bfeedback\b.*\bethos\b.*\bwell\b",
+)
+_NEEDLE_UNION = re.compile("|".join(f"(?:{p})" for p in _NEEDLES))
+_WS_RE = re.compile(r"\s+")
+_TEXTIEST_SAMPLE_ROWS = 256  # rows scored per column in the textiest-column fallback
+_NON_TEXT_TYPES = (int, float, datetime.date, datetime.time, datetime.timedelta)
+
 def load_state():
     if RESET_STATE:
-        print("[debug] RESET_STATE=true → starting from -1 and deleting state file if present")
+        log.debug("RESET_STATE=true → starting from -1 and deleting state file if present")
         try:
             if os.path.exists(STATE_FILE):
                 os.remove(STATE_FILE)
         except Exception as e:
-            print(f"[warn] Could not delete state file: {e}")
+            log.warning("Could not delete state file: %s", e)
         return {"last_index": -1}
     if os.path.exists(STATE_FILE):
         with open(STATE_FILE, "r", encoding="utf-8") as f:
             s = json.load(f)
-            print(f"[debug] Loaded state: {s}")
+            log.debug("Loaded state: %s", s)
             return s
-    print("[debug] No state file found, starting from -1")
+    log.debug("No state file found, starting from -1")
     return {"last_index": -1}
 
 def save_state(s):
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(s, f)
-    print(f"[debug] Saved state: {s}")
+    # Write to a temp file and swap it in so the state file is never half-written
+    tmp = STATE_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_dumps(s))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, STATE_FILE)
+    # Persist the rename itself (POSIX only; Windows can't open directories)
+    if os.name == "posix":
+        dir_fd = os.open(os.path.dirname(os.path.abspath(STATE_FILE)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    log.debug("Saved state: %s", s)
 
-def fetch_dataframe() -> pd.DataFrame:
-    print(f"[debug] Reading Excel from: {EXCEL_PATH} (sheet={SHEET_NAME or 0})")
-    df = pd.read_excel(EXCEL_PATH, sheet_name=SHEET_NAME or 0, header=0)
-    print(f"[debug] Columns: {list(df.columns)}  | rows: {len(df)}")
-    return df.fillna("")
+def iter_rows() -> Iterator[list]:
+    # Stream the sheet one row at a time (header row first) instead of loading a DataFrame
+    log.debug("Reading Excel from: %s (sheet=%s)", EXCEL_PATH, SHEET_NAME or 0)
+    if CalamineWorkbook is not None:
+        wb = CalamineWorkbook.from_path(EXCEL_PATH)
+        ws = wb.get_sheet_by_name(SHEET_NAME) if SHEET_NAME else wb.get_sheet_by_index(0)
+        rows = ws.iter_rows()
+    else:
+        log.warning("python-calamine unavailable, falling back to openpyxl")
+        import openpyxl
+        # read_only streams cells lazily instead of building the full cell graph
+        wb = openpyxl.load_workbook(EXCEL_PATH, read_only=True, data_only=True)
+        ws = wb[SHEET_NAME] if SHEET_NAME else wb.worksheets[0]
+        rows = ws.iter_rows(values_only=True)
+    try:
+        for row in rows:
+            # Blank rows don't count as data rows (same as pandas), so indices stay stable
+            if any(v is not None and v != "" for v in row):
+                yield list(row)
+    finally:
+        # read-only openpyxl keeps the archive open until closed
+        if CalamineWorkbook is None:
+            wb.close()
 
+def _unique_headers(header_row: list) -> list:
+    # Same names pandas gave: blanks become "Unnamed: N", repeats get ".1", ".2"...
+    headers, seen = [], {}
+    for i, h in enumerate(header_row):
+        name = f"Unnamed: {i}" if h is None or h == "" else h
+        if name in seen:
+            base = name
+            while name in seen:
+                seen[base] += 1
+                name = f"{base}.{seen[base]}"
+        seen[name] = 0
+        headers.append(name)
+    return headers
+
+def _cell(row: list, i) -> str:
+    # The one place a cell is coerced: stripped str, "" for missing/empty
+    if i is None or i >= len(row) or row[i] is None:
+        return ""
+    v = row[i]
+    if type(v) is str:
+        return v.strip()
+    # calamine returns every number as float; print whole numbers as ints like
+    # pandas/openpyxl did, so post text doesn't depend on the reader
+    if type(v) is float and v.is_integer():
+        return str(int(v))
+    return str(v).strip()
+
+@lru_cache(maxsize=512)
 def _norm(s: str) -> str:
-    return re.sub(r"\s+", " ", str(s).strip().lower())
+    return _WS_RE.sub(" ", str(s).strip().lower())
 
-def find_review_column(df: pd.DataFrame) -> str:
-    cols = list(df.columns)
+def match_review_header(cols) -> str | None:
+    # Header-only detection: MESSAGE_COL override, then the ETHOS question patterns.
+    # cols can be a list or main's header->position dict (O(1) override check)
     if MESSAGE_COL in cols:
-        print(f"[info] Using MESSAGE_COL override: {MESSAGE_COL}")
+        log.info("Using MESSAGE_COL override: %s", MESSAGE_COL)
         return MESSAGE_COL
 
-    norm_cols = {col: _norm(col) for col in cols}
-    needles = [
-        r"\bethos\b.*\b(did|does)\b.*\bwell\b",
-        r"\bwhat\b.*\bethos\b.*\bwell\b",
-        r"\bwhat went well\b.*\bethos\b",
-        r"\bfeedback\b.*\bethos\b.*\bwell\b",
-    ]
-    for col, nc in norm_cols.items():
-        if any(re.search(p, nc) for p in needles):
-            print(f"[info] Auto-detected review column: {col}")
+    for col in cols:
+        if _NEEDLE_UNION.search(_norm(col)):
+            log.info("Auto-detected review column: %s", col)
             return col
+    return None
 
-    def avg_len(series: pd.Series) -> float:
-        try:
-            return series.astype(str).str.len().mean()
-        except Exception:
-            return 0.0
+def schema_fingerprint(headers: list, sample_rows: int) -> str:
+    # Header row hash (not mtime: a fresh checkout touches every file) plus the
+    # settings and sample size that influence the textiest fallback; responses
+    # are appended, so the sample only changes when it grows (up to 256 rows)
+    key = "\x1f".join([str(SHEET_NAME), MESSAGE_COL, str(sample_rows), *map(str, headers)])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
 
-    textiest = max(cols, key=lambda c: avg_len(df[c]))
-    print(f"[warn] Falling back to textiest column: {textiest}")
+def textiest_column(headers: list, sample: list) -> str:
+    # One pass over the sample per column: type check and length sum together.
+    # Columns whose sampled values are all numbers/dates can't be the review
+    # text, so they only win if nothing textual was found
+    n = len(sample)
+    textiest, best_score = None, -1.0
+    fallback, fallback_score = None, -1.0
+    for i, col in enumerate(headers):
+        total, seen, texty = 0, False, False
+        for row in sample:
+            v = row[i] if i < len(row) else None
+            if v is None or v == "":
+                continue
+            seen = True
+            if not isinstance(v, _NON_TEXT_TYPES):
+                texty = True
+            total += len(_cell(row, i))
+        score = total / n if n else 0.0
+        if texty or not seen:
+            if score > best_score:
+                textiest, best_score = col, score
+        elif score > fallback_score:
+            fallback, fallback_score = col, score
+    if textiest is None:
+        log.warning("No textual column found in sample, scoring numeric/date columns too")
+        textiest = fallback
+    log.warning("Falling back to textiest column: %s", textiest)
     return textiest
 
-def format_post(row: dict, review_col: str) -> str:
-    review = str(row.get(review_col, "")).strip()
-    name = (str(row.get(NAME_COL, "Anonymous")).strip() or "Anonymous")
-    ts   = str(row.get(TIMESTAMP_COL, "")).strip()
-
+def format_post(review: str, name: str, ts: str) -> str:
+    # Inputs come from _cell, so they're already clean strings
     if not review:
         return ""
-    base = review
-    if name:
-        base += f"\n— {name}"
+    parts = [review, "\n— ", name or "Anonymous"]
     if ts:
-        base += f" • {ts}"
-    return base[:290]
+        parts += (" • ", ts)
+    return "".join(parts)[:290]
+
+def _is_rate_limited(e: Exception) -> bool:
+    return getattr(getattr(e, "response", None), "status_code", None) == 429
+
+class RateGate:
+    # The only pacer: spaces sends `interval` apart across every in-flight post;
+    # a 429 on any of them pauses all sends and widens the spacing
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.pause_until = 0.0
+        self.next_slot = 0.0
+
+    async def wait(self):
+        while True:
+            now = time.monotonic()
+            slot = max(self.pause_until, self.next_slot)
+            if slot <= now:
+                self.next_slot = now + self.interval
+                return
+            await asyncio.sleep(slot - now)
+
+    def back_off(self, delay: float):
+        self.pause_until = max(self.pause_until, time.monotonic() + delay)
+        self.interval = min(max(self.interval * 2, 1.0), 60.0)
+
+async def send_with_backoff(client: AsyncClient, text: str, gate: RateGate):
+    for attempt in range(MAX_RETRIES + 1):
+        await gate.wait()
+        try:
+            return await client.send_post(text=text)
+        except Exception as e:
+            if not _is_rate_limited(e) or attempt == MAX_RETRIES:
+                raise
+            delay = max(POST_INTERVAL, 1.0) * (2 ** attempt)
+            log.warning("Rate limited (attempt %d/%d), pausing all posts %.1fs", attempt + 1, MAX_RETRIES, delay)
+            gate.back_off(delay)
+
+async def post_rows(pending: list, start: int, review_col: str, state: dict, ahead: set) -> int:
+    client = AsyncClient()
+    log.debug("Logging in to Bluesky as %s", BSKY_HANDLE)
+    await client.login(BSKY_HANDLE, BSKY_APP_PWD)
+
+    # Posts finish out of order, so last_index only advances over a contiguous
+    # run of finished rows; a failed row is never skipped on the next run.
+    # Rows posted beyond that run are kept in posted_ahead so they aren't reposted.
+    state["last_index"] = start - 1
+    finished = {i for i in ahead if i >= start}
+
+    def mark_done(idx: int):
+        finished.add(idx)
+        while state["last_index"] + 1 in finished:
+            state["last_index"] += 1
+            finished.remove(state["last_index"])
+        state["posted_ahead"] = sorted(finished)
+
+    work = []
+    for idx, text in pending:
+        if text.strip():
+            work.append((idx, text))
+        else:
+            log.info("Skipped row %d: empty or no review text", idx)
+            mark_done(idx)
+
+    posted = 0
+    errors = []
+    gate = RateGate(POST_INTERVAL)
+
+    async def post_one(item: tuple):
+        nonlocal posted
+        idx, text = item
+        # Failures are caught here so one bad post doesn't cancel sibling sends
+        # that are already in flight; the first error is re-raised at the end
+        try:
+            await send_with_backoff(client, text, gate)
+        except Exception as e:
+            log.error("Failed to post row %d: %s", idx, e)
+            errors.append(e)
+            return
+        posted += 1
+        if log.isEnabledFor(logging.INFO):
+            log.info("Posted row %d (%s): %s...", idx, review_col, text[:120])
+        mark_done(idx)
+        if posted % SAVE_EVERY == 0:
+            save_state(state)
+
+    # State is flushed every SAVE_EVERY posts and once on exit (including errors)
+    try:
+        await aiometer.run_on_each(post_one, work, max_at_once=POST_CONCURRENCY)
+    finally:
+        save_state(state)
+    if errors:
+        raise errors[0]
+    return posted
 
 def main():
     state = load_state()
-    df = fetch_dataframe()
-    if df.empty:
-        print("[info] No data found in sheet.")
+    rows = iter_rows()
+    header_row = next(rows, None)
+    if header_row is None:
+        log.info("No data found in sheet.")
         return
+    headers = _unique_headers(header_row)
+    # Header -> position, built once (names are unique, so lookups are exact)
+    pos = {h: i for i, h in enumerate(headers)}
 
-    review_col = find_review_column(df)
-    print(f"[debug] Using review column: {review_col}")
-    rows = df.to_dict("records")
-
-    # Show first 3 extracted texts for sanity
-    samples = []
-    for i in range(min(3, len(rows))):
-        t = format_post(rows[i], review_col)
-        samples.append(t[:120])
-    print(f"[debug] First 3 formatted samples: {samples}")
+    review_col = match_review_header(pos)
+    cache_dirty = False
+    if review_col is None:
+        # Textiest-column fallback only needs a small sample; put it back in the stream
+        sample = list(islice(rows, _TEXTIEST_SAMPLE_ROWS))
+        rows = chain(sample, rows)
+        # Reuse the fallback's pick while headers and sample size are unchanged;
+        # an empty sample proves nothing, so it is never cached
+        fp = schema_fingerprint(headers, len(sample))
+        if sample and state.get("schema_fp") == fp and state.get("review_col") in pos:
+            review_col = state["review_col"]
+            log.debug("Schema unchanged, reusing cached review column")
+        else:
+            review_col = textiest_column(headers, sample)
+            if sample:
+                state["schema_fp"] = fp
+                state["review_col"] = review_col
+                cache_dirty = True
+    log.debug("Using review column: %s", review_col)
+    ri = pos[review_col]
+    ni = pos.get(NAME_COL)
+    ti = pos.get(TIMESTAMP_COL)
 
     start = state["last_index"] + 1
-    print(f"[debug] Last index was {state['last_index']} → starting at {start} of {len(rows)} rows")
-
     # Force posts if requested
     if FORCE_POST_FIRST_N > 0:
-        print(f"[debug] FORCE_POST_FIRST_N={FORCE_POST_FIRST_N} → will post first N rows regardless of state")
+        log.debug("FORCE_POST_FIRST_N=%d → will post first N rows regardless of state", FORCE_POST_FIRST_N)
         start = 0
+    end = FORCE_POST_FIRST_N if FORCE_POST_FIRST_N > 0 else None
+    # Rows a previous run posted past its failure point (ignored when forcing)
+    ahead = set() if FORCE_POST_FIRST_N > 0 else set(state.get("posted_ahead", []))
 
-    if start >= len(rows) and FORCE_POST_FIRST_N == 0:
-        print("[info] No new rows to post.")
+    # Single streaming pass: only rows to post (plus 3 sanity samples when
+    # debugging) get formatted
+    want_samples = log.isEnabledFor(logging.DEBUG)
+    samples = []
+    pending = []
+    n_rows = 0
+    for idx, row in enumerate(rows):
+        n_rows = idx + 1
+        in_range = idx >= start and (end is None or idx < end) and idx not in ahead
+        sample_row = want_samples and idx < 3
+        if sample_row or in_range:
+            text = format_post(_cell(row, ri), _cell(row, ni), _cell(row, ti))
+            if sample_row:
+                samples.append(text[:120])
+            if in_range:
+                pending.append((idx, text))
+
+    if n_rows == 0:
+        log.info("No data found in sheet.")
         return
+    if cache_dirty:
+        save_state(state)
+    log.debug("Columns: %s  | rows: %d", headers, n_rows)
+    log.debug("First 3 formatted samples: %s", samples)
+    log.debug("Last index was %d → starting at %d of %d rows", state["last_index"], start, n_rows)
 
-    client = Client()
-    print(f"[debug] Logging in to Bluesky as {BSKY_HANDLE}")
-    client.login(BSKY_HANDLE, BSKY_APP_PWD)
+    if not pending and FORCE_POST_FIRST_N == 0:
+        log.info("No new rows to post.")
+        return
 
-    posted = 0
-    end = len(rows) if FORCE_POST_FIRST_N == 0 else min(FORCE_POST_FIRST_N, len(rows))
-    for idx in range(start, end):
-        text = format_post(rows[idx], review_col)
-        if text.strip():
-            client.send_post(text=text)
-            posted += 1
-            print(f"[posted] row {idx} ({review_col}): {text[:120]}...")
-            time.sleep(2)
-        else:
-            print(f"[skip] row {idx}: empty or no review text")
-        state["last_index"] = idx
-        save_state(state)
+    posted = asyncio.run(post_rows(pending, start, review_col, state, ahead))
 
-    print(f"[info] Done. Posted {posted} item(s).")
+    log.info("Done. Posted %d item(s).", posted)
 
 if __name__ == "__main__":
     main()